@@ -32,6 +32,26 @@ class Database(object):
         package.backend.install_many(self.packages[package.backend.FORMAT])
         system.enable_and_start_service(self.service)
 
+    def _quote(self, value):
+        """Return value as a quoted SQL string literal."""
+        return "'{}'".format(value.replace("'", "''"))
+
+    def _exec_query_params(self, query, params, dbname=None, dbuser=None,
+                           dbpassword=None):
+        """Exec a query, replacing %s placeholders with quoted params.
+
+        Only %s is substituted, any other % character is left as is.
+        """
+        parts = query.split("%s")
+        if len(parts) != len(params) + 1:
+            raise ValueError(
+                "Query expects {} parameters, got {}"
+                .format(len(parts) - 1, len(params)))
+        query = parts[0]
+        for param, part in zip(params, parts[1:]):
+            query += self._quote(param) + part
+        self._exec_query(query, dbname, dbuser, dbpassword)
+
 
 class PostgreSQL(Database):
 
@@ -134,6 +154,11 @@ class MySQL(Database):
         """Replace special characters."""
         return query.replace("'", "'\"'\"'")
 
+    def _quote(self, value):
+        """Return value as a quoted SQL string literal."""
+        value = value.replace("\\", "\\\\").replace("'", "''")
+        return "'{}'".format(value)
+
     def install_package(self):
         """Preseed package installation."""
         name, version, _id = platform.linux_distribution()
@@ -3,9 +3,10 @@
 import json
 import os
 import pwd
-import shutil
 import stat
+import subprocess
 import sys
+import tempfile
 
 from .. import compatibility_matrix
 from .. import package
@@ -14,6 +15,24 @@ from .. import utils
 
 from . import base
 
+# Python versions older than 2.7.9 (e.g. CentOS 7's 2.7.5) need extra
+# packages to support SNI
+_NEEDS_SNI_FIX = sys.version_info.major == 2 and sys.version_info.micro < 9
+
+# Minimal Modoboa version required by each extension, as integers
+EXTENSIONS_AVAILABILITY_INT = {
+    extension: utils.convert_version_to_int(version)
+    for extension, version in
+    compatibility_matrix.EXTENSIONS_AVAILABILITY.items()
+}
+
+
+def get_bool(config, section, option):
+    """Return a boolean option, False if it is not defined."""
+    return (
+        config.has_option(section, option) and
+        config.getboolean(section, option))
+
 
 class Modoboa(base.Installer):
     """Modoboa installation."""
@@ -42,23 +61,33 @@ class Modoboa(base.Installer):
         self.venv_path = config.get("modoboa", "venv_path")
         self.instance_path = config.get("modoboa", "instance_path")
         self.extensions = config.get("modoboa", "extensions").split()
-        self.devmode = config.getboolean("modoboa", "devmode")
+        self.devmode = get_bool(config, "modoboa", "devmode")
+        self.hostname = config.get("general", "hostname")
+        self.timezone = config.get("modoboa", "timezone")
+        self._cleanup_process = None
+        self._cached_packages = None
         # Sanity check for amavis
+        self.amavis_enabled_cfg = get_bool(config, "amavis", "enabled")
         self.amavis_enabled = False
         if "modoboa-amavis" in self.extensions:
-            if self.config.getboolean("amavis", "enabled"):
+            if self.amavis_enabled_cfg:
                 self.amavis_enabled = True
             else:
-                self.extensions.remove("modoboa-amavis")
+                self.extensions = [
+                    extension for extension in self.extensions
+                    if extension != "modoboa-amavis"]
+        if self.amavis_enabled:
+            self.amavis_dbuser = config.get("amavis", "dbuser")
+            self.amavis_dbpassword = config.get("amavis", "dbpassword")
+            self.amavis_dbname = config.get("amavis", "dbname")
+
+    def is_extension_ok_for_version(self, extension, version_int):
+        """Check if extension can be installed with this modo version.
 
-    def is_extension_ok_for_version(self, extension, version):
-        """Check if extension can be installed with this modo version."""
-        if extension not in compatibility_matrix.EXTENSIONS_AVAILABILITY:
-            return True
-        version = utils.convert_version_to_int(version)
-        min_version = compatibility_matrix.EXTENSIONS_AVAILABILITY[extension]
-        min_version = utils.convert_version_to_int(min_version)
-        return version >= min_version
+        :param int version_int: version as returned by
+                                :func:`utils.convert_version_to_int`
+        """
+        return version_int >= EXTENSIONS_AVAILABILITY_INT.get(extension, 0)
 
     def _setup_venv(self):
         """Prepare a dedicated virtualenv."""
@@ -70,36 +99,64 @@ class Modoboa(base.Installer):
         else:
             matrix = compatibility_matrix.COMPATIBILITY_MATRIX[version]
             packages.append("modoboa=={}".format(version))
-            for extension in list(self.extensions):
-                if not self.is_extension_ok_for_version(extension, version):
-                    self.extensions.remove(extension)
+            version_int = utils.convert_version_to_int(version)
+            kept, new_packages = [], []
+            for extension in self.extensions:
+                if not self.is_extension_ok_for_version(
+                        extension, version_int):
                     continue
+                kept.append(extension)
                 if extension in matrix:
                     req_version = matrix[extension]
                     req_version = req_version.replace("<", "\<")
                     req_version = req_version.replace(">", "\>")
-                    packages.append("{}{}".format(extension, req_version))
+                    new_packages.append(
+                        "{}{}".format(extension, req_version))
                 else:
-                    packages.append(extension)
+                    new_packages.append(extension)
+            self.extensions = kept
+            packages.extend(new_packages)
         if self.dbengine == "postgres":
-            packages.append("psycopg2")
+            packages.append("psycopg2-binary")
         else:
-            packages.append("MYSQL-Python")
-        if sys.version_info.major == 2 and sys.version_info.micro < 9:
+            packages.append("mysqlclient")
+        if _NEEDS_SNI_FIX:
             # Add extra packages to fix the SNI issue
             packages += ["pyOpenSSL"]
-        python.install_packages(packages, self.venv_path, sudo_user=self.user)
         if self.devmode:
             # FIXME: use dev-requirements instead
-            python.install_packages(
-                ["django-bower", "django-debug-toolbar"], self.venv_path,
-                sudo_user=self.user)
+            packages += ["django-bower", "django-debug-toolbar"]
+        python.install_packages(packages, self.venv_path, sudo_user=self.user)
+
+    def _start_cleanup(self, paths):
+        """Remove paths in the background."""
+        kwargs = {}
+        if not utils.ENV.get("debug"):
+            kwargs.update(stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self._cleanup_process = subprocess.Popen(
+            ["rm", "-rf"] + paths, close_fds=True, **kwargs)
+
+    def _wait_for_cleanup(self):
+        """Wait for the background removal started by _start_cleanup."""
+        if self._cleanup_process is None:
+            return
+        output = self._cleanup_process.communicate()[0]
+        code = self._cleanup_process.returncode
+        if code:
+            utils.printcolor(
+                "Failed to remove old Modoboa instance (exit code {}): {}"
+                .format(code, output.decode("utf-8", "replace")
+                        if output else ""),
+                utils.YELLOW
+            )
+        self._cleanup_process = None
 
     def _deploy_instance(self):
         """Deploy Modoboa."""
         target = os.path.join(self.home_dir, "instance")
+        force = get_bool(self.config, "general", "force")
         if os.path.exists(target):
-            if not self.config.getboolean("general", "force"):
+            if not force:
                 utils.printcolor(
                     "Target directory for Modoboa deployment ({}) already "
                     "exists. If you choose to continue, it will be removed."
@@ -109,37 +166,47 @@ class Modoboa(base.Installer):
                 answer = utils.user_input("Do you confirm? (Y/n) ")
                 if answer.lower().startswith("n"):
                     return
-            shutil.rmtree(target)
+            # Move the old instance into a new, uniquely named directory
+            # and remove it in the background, it will be waited for in
+            # post_run.
+            old_dir = tempfile.mkdtemp(
+                prefix="instance.old.", dir=self.home_dir)
+            os.rename(target, os.path.join(old_dir, "instance"))
+            self._start_cleanup([old_dir])
 
-        prefix = ". {}; ".format(
-            os.path.join(self.venv_path, "bin", "activate"))
+        dburls = [
+            "default:{}://{}:{}@{}/{}".format(
+                self.dbengine, self.dbuser, self.dbpasswd, self.dbhost,
+                self.dbname
+            )
+        ]
+        if self.amavis_enabled:
+            dburls.append(
+                "amavis:{}://{}:{}@{}/{}".format(
+                    self.dbengine, self.amavis_dbuser, self.amavis_dbpassword,
+                    self.dbhost, self.amavis_dbname
+                )
+            )
         args = [
             "--collectstatic",
-            "--timezone", self.config.get("modoboa", "timezone"),
-            "--domain", self.config.get("general", "hostname"),
-            "--extensions", " ".join(self.extensions),
+            "--timezone", self.timezone,
+            "--domain", self.hostname,
             "--dont-install-extensions",
-            "--dburl", "'default:{}://{}:{}@{}/{}'".format(
-                self.config.get("database", "engine"),
-                self.dbuser, self.dbpasswd, self.dbhost, self.dbname
-            )
-        ]
+            "--extensions"
+        ] + self.extensions + ["--dburl"] + dburls
         if self.devmode:
             args = ["--devel"] + args
-        if self.amavis_enabled:
-            args += [
-                "'amavis:{}://{}:{}@{}/{}'".format(
-                    self.config.get("database", "engine"),
-                    self.config.get("amavis", "dbuser"),
-                    self.config.get("amavis", "dbpassword"),
-                    self.dbhost,
-                    self.config.get("amavis", "dbname")
-                )
-            ]
+        # modoboa-admin.py runs "python manage.py ..." through a shell,
+        # so the virtualenv must come first in PATH.
+        cmd = [
+            "env", "PATH={}:/usr/local/bin:/usr/bin:/bin".format(
+                os.path.join(self.venv_path, "bin")),
+            python.get_path("python", self.venv_path),
+            python.get_path("modoboa-admin.py", self.venv_path),
+            "deploy", "instance"
+        ] + args
         code, output = utils.exec_cmd(
-            "bash -c '{} modoboa-admin.py deploy instance {}'".format(
-                prefix, " ".join(args)),
-            sudo_user=self.user, cwd=self.home_dir)
+            cmd, sudo_user=self.user, cwd=self.home_dir)
         if code:
             raise utils.FatalError(output)
 
@@ -148,33 +215,30 @@ class Modoboa(base.Installer):
         super(Modoboa, self).setup_database()
         if not self.amavis_enabled:
             return
-        self.backend.grant_access(
-            self.config.get("amavis", "dbname"), self.dbuser)
+        self.backend.grant_access(self.amavis_dbname, self.dbuser)
 
     def get_packages(self):
         """Include extra packages if needed."""
-        packages = super(Modoboa, self).get_packages()
-        condition = (
-            package.backend.FORMAT == "rpm" and
-            sys.version_info.major == 2 and
-            sys.version_info.micro < 9)
-        if condition:
+        if self._cached_packages is not None:
+            return self._cached_packages
+        packages = list(super(Modoboa, self).get_packages())
+        if package.backend.FORMAT == "rpm" and _NEEDS_SNI_FIX:
             # Add extra packages to fix the SNI issue
             packages += ["openssl-devel"]
+        self._cached_packages = packages
         return packages
 
     def get_template_context(self):
         """Additional variables."""
         context = super(Modoboa, self).get_template_context()
-        extensions = self.config.get("modoboa", "extensions")
-        extensions = extensions.split()
         context.update({
             "sudo_user": (
                 "uwsgi" if package.backend.FORMAT == "rpm" else context["user"]
             ),
             "dovecot_mailboxes_owner": (
                 self.config.get("dovecot", "mailboxes_owner")),
-            "radicale_enabled": "" if "modoboa-radicale" in extensions else "#"
+            "radicale_enabled": (
+                "" if "modoboa-radicale" in self.extensions else "#")
         })
         return context
 
@@ -185,8 +249,9 @@ class Modoboa(base.Installer):
         webmail_media_dir = os.path.join(
             self.instance_path, "media", "webmail")
         pw = pwd.getpwnam(self.user)
-        for d in [rrd_root_dir, pdf_storage_dir, webmail_media_dir]:
-            utils.mkdir(d, stat.S_IRWXU | stat.S_IRWXG, pw[2], pw[3])
+        mode = stat.S_IRWXU | stat.S_IRWXG
+        for d in (rrd_root_dir, pdf_storage_dir, webmail_media_dir):
+            utils.mkdir(d, mode, pw.pw_uid, pw.pw_gid)
         settings = {
             "admin": {
                 "handle_mailboxes": True,
@@ -210,19 +275,21 @@ class Modoboa(base.Installer):
                 "storage_dir": pdf_storage_dir
             }
         }
-        for path in ["/var/log/maillog", "/var/log/mail.log"]:
-            if os.path.exists(path):
-                settings["modoboa_stats"]["logfile"] = path
-        settings = json.dumps(settings)
-        query = (
-            "UPDATE core_localconfig SET _parameters='{}'"
-            .format(settings)
-        )
-        self.backend._exec_query(
-            query, self.dbname, self.dbuser, self.dbpasswd)
+        logfile = next(
+            (path for path in ("/var/log/maillog", "/var/log/mail.log")
+             if os.path.exists(path)), None)
+        if logfile:
+            settings["modoboa_stats"]["logfile"] = logfile
+        self.backend._exec_query_params(
+            "UPDATE core_localconfig SET _parameters=%s",
+            (json.dumps(settings, separators=(",", ":")), ),
+            self.dbname, self.dbuser, self.dbpasswd)
 
     def post_run(self):
         """Additional tasks."""
-        self._setup_venv()
-        self._deploy_instance()
-        self.apply_settings()
+        try:
+            self._setup_venv()
+            self._deploy_instance()
+            self.apply_settings()
+        finally:
+            self._wait_for_cleanup()
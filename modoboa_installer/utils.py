@@ -43,18 +43,24 @@ def user_input(message):
 def exec_cmd(cmd, sudo_user=None, pinput=None, login=True, **kwargs):
     """Execute a shell command.
     Run a command using the current user. Set :keyword:`sudo_user` if
-    you need different privileges.
-    :param str cmd: the command to execute
+    you need different privileges. If :keyword:`cmd` is a list, it is
+    executed directly, without a shell.
+    :param cmd: the command to execute (str or list)
     :param str sudo_user: a valid system username
     :param str pinput: data to send to process's stdin
     :rtype: tuple
     :return: return code, command output
     """
     sudo_user = ENV.get("sudo_user", sudo_user)
-    if sudo_user is not None:
+    if isinstance(cmd, list):
+        if sudo_user is not None:
+            cmd = (
+                ["sudo"] + (["-i"] if login else []) + ["-u", sudo_user] +
+                cmd
+            )
+    elif sudo_user is not None:
         cmd = "sudo {}-u {} {}".format("-i " if login else "", sudo_user, cmd)
-    if "shell" not in kwargs:
-        kwargs["shell"] = True
+    kwargs.setdefault("shell", not isinstance(cmd, list))
     if pinput is not None:
         kwargs["stdin"] = subprocess.PIPE
     capture_output = False